@@ -4,83 +4,250 @@
 pokerok.py — набор утилит для проверки и взаимодействия с pokerok.dmg
 
 Возможности (все подкоманды смотрят на один файл DMG):
-  - hash        — посчитать SHA-256 и размер файла
+  - hash        — посчитать SHA-256 (или BLAKE3: --algo blake3) и размер файла
   - info        — прочесть метаданные образа через hdiutil (plist)
   - mount       — смонтировать образ (ro, nobrowse) и вернуть точку монтирования + устройство
   - list        — смонтировать, показать содержимое верхнего уровня, затем отмонтировать
   - copy        — смонтировать и скопировать .app в указанную директорию (по умолчанию /Applications)
   - verify      — проверить .app (Gatekeeper: spctl) и подпись (codesign) из смонтированного образа
+  - full        — hash + verify за один запуск: хеш считается параллельно с монтированием
+  - serve       — смонтировать один раз и обслуживать list/verify/copy/hash через Unix-сокет
   - detach      — отмонтировать по устройству (-dev) или пути монтирования (-m)
 
 Примеры:
   python3 pokerok_dmg_tools.py hash pokerok.dmg
+  python3 pokerok_dmg_tools.py hash pokerok.dmg --algo blake3
+  python3 pokerok_dmg_tools.py hash pokerok.dmg --algo sha256-tree
   python3 pokerok_dmg_tools.py info pokerok.dmg
   python3 pokerok_dmg_tools.py list pokerok.dmg
   python3 pokerok_dmg_tools.py copy pokerok.dmg --dest /Applications --dry-run
   python3 pokerok_dmg_tools.py verify pokerok.dmg
+  python3 pokerok_dmg_tools.py verify pokerok.dmg --fast
+  python3 pokerok_dmg_tools.py full pokerok.dmg
   python3 pokerok_dmg_tools.py mount pokerok.dmg --mountpoint /tmp/pokerok_mnt
   python3 pokerok_dmg_tools.py detach -m /tmp/pokerok_mnt
+  python3 pokerok_dmg_tools.py serve pokerok.dmg   # затем: echo '{"op": "verify"}' | nc -U /tmp/pokerok.sock
 """
 
 import argparse
 import hashlib
+import mmap
 import os
-import plistlib
 import shutil
+import stat
 import subprocess
 import sys
-import tempfile
+import threading
+from contextlib import contextmanager, redirect_stdout
 from pathlib import Path
 from typing import Optional, Tuple
 
+# plistlib, tempfile и concurrent.futures импортируются внутри функций,
+# которым они нужны: `hash` не должен платить за них при запуске
+
 def run(cmd, check=True) -> subprocess.CompletedProcess:
     return subprocess.run(cmd, check=check, text=True, capture_output=True)
 
-def sha256sum(path: Path) -> Tuple[str, int]:
+def run_bytes(cmd, check=True) -> subprocess.CompletedProcess:
+    # stdout в байтах — для plist-вывода hdiutil, чтобы не декодировать и снова кодировать
+    return subprocess.run(cmd, check=check, capture_output=True)
+
+HASH_BUFSIZE = 4 * 1024 * 1024
+
+# Значения из <sys/fcntl.h> macOS; в модуле fcntl их может не быть
+F_RDAHEAD = 45
+F_NOCACHE = 48
+
+def advise_sequential(fd: int, drop_cache: bool = False) -> None:
+    # Подсказка ядру: читаем файл один раз от начала до конца.
+    # Только подсказка — на pipe/сокете (ESPIPE) и т.п. молча продолжаем без нее
+    try:
+        if sys.platform == 'darwin':
+            import fcntl
+            fcntl.fcntl(fd, getattr(fcntl, 'F_RDAHEAD', F_RDAHEAD), 1)
+            if drop_cache:
+                fcntl.fcntl(fd, getattr(fcntl, 'F_NOCACHE', F_NOCACHE), 1)
+        elif hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+
+def advise_dontneed(fd: int) -> None:
+    # На Linux аналог F_NOCACHE — выбросить уже прочитанные страницы из кэша
+    if sys.platform == 'darwin' or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+MMAP_HASH_LIMIT = 2 * 1024 ** 3
+
+def sha256_readinto(f) -> Tuple[str, int]:
     h = hashlib.sha256()
     total = 0
-    with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b''):
-            h.update(chunk)
-            total += len(chunk)
+    # Один буфер на весь файл: readinto без лишних аллокаций bytes на каждой итерации
+    view = memoryview(bytearray(HASH_BUFSIZE))
+    while True:
+        n = f.readinto(view)
+        if not n:
+            break
+        h.update(view[:n])
+        total += n
     return h.hexdigest(), total
 
+def sha256sum(path: Path, drop_cache: bool = False) -> Tuple[str, int]:
+    size = path.stat().st_size
+    if 0 < size < MMAP_HASH_LIMIT and not drop_cache:
+        # Весь образ одним вызовом hashlib из mmap: без цикла в Python и без копий буфера
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            return hashlib.sha256(mm).hexdigest(), len(mm)
+    with open(path, 'rb', buffering=0) as f:
+        advise_sequential(f.fileno(), drop_cache)
+        digest, total = sha256_readinto(f)
+        if drop_cache:
+            advise_dontneed(f.fileno())
+    return digest, total
+
+def blake3sum(path: Path) -> Tuple[str, int]:
+    # Необязательная зависимость: pip install blake3 (SIMD + многопоточность внутри библиотеки)
+    try:
+        from blake3 import blake3
+    except ImportError:
+        raise RuntimeError("Для --algo blake3 нужен пакет blake3: pip3 install blake3")
+    h = blake3(max_threads=blake3.AUTO)
+    with open(path, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode):
+            h.update_mmap(str(path))
+            return h.hexdigest(), st.st_size
+        # pipe, <(...) и т.п.: mmap невозможен, а st_size там 0 — читаем поток и считаем байты сами
+        total = 0
+        view = memoryview(bytearray(HASH_BUFSIZE))
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            h.update(view[:n])
+            total += n
+    return h.hexdigest(), total
+
+TREE_CHUNK = 64 * 1024 * 1024
+
+def check_cancel(cancel: Optional[threading.Event]) -> None:
+    if cancel is not None and cancel.is_set():
+        raise RuntimeError("Хеширование прервано.")
+
+def sha256tree(path: Path, cancel: Optional[threading.Event] = None) -> Tuple[str, int]:
+    """
+    SHA-256 от конкатенации SHA-256 блоков по 64 МиБ. Блоки хешируются параллельно
+    из mmap, поэтому результат НЕ совпадает с обычным sha256 файла.
+    cancel — событие, после которого оставшиеся блоки не хешируются (см. cmd_full).
+    """
+    import concurrent.futures
+    with open(path, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            # pipe, <(...) и т.п.: st_size там 0, а mmap невозможен — те же блоки, но последовательно
+            return sha256tree_stream(f, cancel)
+        size = st.st_size
+        if size == 0:
+            return hashlib.sha256().hexdigest(), 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                def hash_block(start):
+                    check_cancel(cancel)
+                    return hashlib.sha256(view[start:start + TREE_CHUNK]).digest()
+
+                # hashlib отпускает GIL на больших буферах — потоки реально работают параллельно
+                futures = [ex.submit(hash_block, start) for start in range(0, size, TREE_CHUNK)]
+                try:
+                    top = hashlib.sha256(b''.join(fut.result() for fut in futures))
+                except BaseException:
+                    # Иначе выход из executor (и из процесса — concurrent.futures ждет
+                    # свои потоки при завершении) дождался бы всех поставленных блоков
+                    for fut in futures:
+                        fut.cancel()
+                    raise
+    return top.hexdigest(), size
+
+def sha256tree_stream(f, cancel: Optional[threading.Event] = None) -> Tuple[str, int]:
+    # Тот же дайджест, что у sha256tree, для потока без mmap: блоки строго по TREE_CHUNK
+    top = hashlib.sha256()
+    total = 0
+    view = memoryview(bytearray(TREE_CHUNK))
+    while True:
+        check_cancel(cancel)
+        n = 0
+        while n < TREE_CHUNK:
+            got = f.readinto(view[n:])
+            if not got:
+                break
+            n += got
+        if not n:
+            break
+        top.update(hashlib.sha256(view[:n]).digest())
+        total += n
+        if n < TREE_CHUNK:
+            break
+    return top.hexdigest(), total
+
+HASHERS = {
+    'sha256': ('SHA-256', sha256sum),
+    'sha256-tree': ('SHA-256 (tree, 64 MiB)', sha256tree),
+    'blake3': ('BLAKE3', blake3sum),
+}
+
 def hdiutil_imageinfo_plist(dmg: Path) -> dict:
-    res = run(['hdiutil', 'imageinfo', '-plist', str(dmg)])
-    return plistlib.loads(res.stdout.encode())
+    import plistlib
+    res = run_bytes(['hdiutil', 'imageinfo', '-plist', str(dmg)])
+    # hdiutil -plist всегда отдает XML — без автоопределения формата
+    return plistlib.loads(res.stdout, fmt=plistlib.FMT_XML)
 
 def hdiutil_attach(dmg: Path, mountpoint: Optional[Path] = None) -> Tuple[Path, str]:
     """
     Возвращает (mountpoint, device). Монтирует read-only, nobrowse, noverify.
     """
+    import plistlib
     args = ['hdiutil', 'attach', str(dmg), '-readonly', '-nobrowse', '-noverify', '-plist']
     if mountpoint:
         mountpoint.mkdir(parents=True, exist_ok=True)
         args += ['-mountpoint', str(mountpoint)]
-    res = run(args)
-    pl = plistlib.loads(res.stdout.encode())
-    # Ищем запись с mount-point и device
-    device = None
-    mnt = None
+    res = run_bytes(args)
+    pl = plistlib.loads(res.stdout)
+    # Один проход: первый mount-point, dev-entry раздела Apple_HFS, иначе первый dev-entry
+    mnt = first_dev = hfs_dev = None
     for ent in pl.get('system-entities', []):
-        if 'mount-point' in ent:
+        if mnt is None and 'mount-point' in ent:
             mnt = Path(ent['mount-point'])
-        if 'dev-entry' in ent and ent.get('content-hint', '').startswith('Apple_HFS'):
-            device = ent['dev-entry']
-    if not mnt:
-        # fallback: берем первый встреченный mount-point
-        for ent in pl.get('system-entities', []):
-            if 'mount-point' in ent:
-                mnt = Path(ent['mount-point']); break
-    if not device:
-        # fallback: первый dev-entry
-        for ent in pl.get('system-entities', []):
-            if 'dev-entry' in ent:
-                device = ent['dev-entry']; break
+        if 'dev-entry' in ent:
+            if first_dev is None:
+                first_dev = ent['dev-entry']
+            if hfs_dev is None and ent.get('content-hint', '').startswith('Apple_HFS'):
+                hfs_dev = ent['dev-entry']
+    device = hfs_dev or first_dev
     if not (mnt and device):
         raise RuntimeError("Не удалось определить точку монтирования или устройство.")
     return mnt, device
 
+@contextmanager
+def mounted(dmg: Path):
+    """
+    Монтирует образ во временную директорию на время блока и отдает (mountpoint, device).
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix='pokerok_mnt_') as tmp:
+        mp, dev = hdiutil_attach(dmg, Path(tmp))
+        try:
+            yield mp, dev
+        finally:
+            hdiutil_detach(dev)
+
 def hdiutil_detach(target: str) -> None:
     # target может быть /dev/diskX или путь монтирования
     try:
@@ -90,17 +257,41 @@ def hdiutil_detach(target: str) -> None:
         run(['hdiutil', 'detach', '-force', target])
 
 def list_top(mountpoint: Path) -> list:
-    items = []
-    for p in sorted(mountpoint.iterdir()):
-        items.append(f"{'[D]' if p.is_dir() else '[F]'} {p.name}")
-    return items
+    # DirEntry.is_dir() берет тип из readdir, без отдельного stat на каждый элемент
+    with os.scandir(mountpoint) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    return [f"{'[D]' if e.is_dir() else '[F]'} {e.name}" for e in entries]
+
+# Глубже .app в DMG не кладут; ограничение защищает от огромных деревьев и петель
+APP_SEARCH_DEPTH = 3
 
 def find_app_bundle(mountpoint: Path) -> Optional[Path]:
-    for p in mountpoint.rglob('*.app'):
-        # Обычно на верхнем уровне
-        return p
+    # Обычно .app лежит на верхнем уровне — сначала смотрим только его, потом обходим вширь
+    level = [str(mountpoint)]
+    for _ in range(APP_SEARCH_DEPTH + 1):
+        subdirs = []
+        for d in level:
+            try:
+                with os.scandir(d) as it:
+                    entries = list(it)
+            except OSError:
+                # Нечитаемый каталог внутри образа не должен срывать поиск
+                continue
+            for e in entries:
+                if not e.is_dir(follow_symlinks=False):
+                    continue
+                if e.name.endswith('.app'):
+                    return Path(e.path)
+                subdirs.append(e.path)
+        level = subdirs
     return None
 
+def require_app_bundle(mountpoint: Path) -> Path:
+    app = find_app_bundle(mountpoint)
+    if not app:
+        raise RuntimeError("В образе не найден .app пакет.")
+    return app
+
 def copy_app(app_src: Path, dest_dir: Path, dry_run: bool = False) -> Path:
     dest_dir.mkdir(parents=True, exist_ok=True)
     dest = dest_dir / app_src.name
@@ -113,6 +304,7 @@ def copy_app(app_src: Path, dest_dir: Path, dry_run: bool = False) -> Path:
             shutil.rmtree(dest)
         else:
             dest.unlink()
+    # copytree по умолчанию копирует через shutil.copy2, а тот сам уходит в fcopyfile (macOS) / sendfile (Linux)
     shutil.copytree(app_src, dest, symlinks=True)
     return dest
 
@@ -124,21 +316,54 @@ def spctl_assess(app_path: Path) -> Tuple[bool, str]:
     except subprocess.CalledProcessError as e:
         return False, (e.stderr or e.stdout).strip()
 
-def codesign_verify(app_path: Path) -> Tuple[bool, str]:
-    # Проверка целостности подписи
+def codesign_verify(app_path: Path, fast: bool = False) -> Tuple[bool, str]:
+    # Проверка целостности подписи. fast — только основной исполняемый файл, без обхода всего пакета
+    if fast:
+        if not (app_path / 'Contents' / '_CodeSignature' / 'CodeResources').is_file():
+            return False, "нет Contents/_CodeSignature/CodeResources — пакет не подписан"
+        args = ['codesign', '--verify', '--verbose=2', str(app_path)]
+    else:
+        args = ['codesign', '--verify', '--deep', '--strict', '--verbose=2', str(app_path)]
     try:
-        res = run(['codesign', '--verify', '--deep', '--strict', '--verbose=2', str(app_path)], check=True)
+        res = run(args, check=True)
         return True, res.stderr.strip() or res.stdout.strip()
     except subprocess.CalledProcessError as e:
         return False, (e.stderr or e.stdout).strip()
 
+def verify_app(app_path: Path, fast: bool = False) -> None:
+    # spctl и codesign независимы — запускаем одновременно, время ~ max, а не сумма
+    import concurrent.futures
+    print(f"Проверяем: {app_path}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as ex:
+        fut_gate = ex.submit(spctl_assess, app_path)
+        fut_sign = ex.submit(codesign_verify, app_path, fast)
+        ok_gate, msg_gate = fut_gate.result()
+        ok_sign, msg_sign = fut_sign.result()
+    print(f"Gatekeeper: {'OK' if ok_gate else 'FAIL'} — {msg_gate}")
+    print(f"codesign:   {'OK' if ok_sign else 'FAIL'}{' (fast)' if fast else ''} — {msg_sign}")
+
+def print_listing(mountpoint: Path) -> None:
+    print(f"Содержимое {mountpoint}:")
+    for line in list_top(mountpoint):
+        print("  ", line)
+
 def cmd_hash(args):
-    h, size = sha256sum(Path(args.dmg))
+    label, hasher = HASHERS[args.algo]
+    if getattr(args, 'drop_cache', False):
+        if args.algo != 'sha256':
+            raise RuntimeError("--drop-cache поддерживается только для --algo sha256")
+        h, size = sha256sum(Path(args.dmg), drop_cache=True)
+    else:
+        h, size = hasher(Path(args.dmg))
     print(f"Файл: {args.dmg}")
-    print(f"SHA-256: {h}")
+    print(f"{label}: {h}")
     print(f"Размер: {size} байт ({size/1024/1024:.2f} МБ)")
 
 def cmd_info(args):
+    if args.raw:
+        # Текстовый вывод hdiutil уже читаемый — plist не нужен вовсе
+        print(run(['hdiutil', 'imageinfo', str(args.dmg)]).stdout, end='')
+        return
     pl = hdiutil_imageinfo_plist(Path(args.dmg))
     fields = {
         'Format': pl.get('Format'),
@@ -155,6 +380,7 @@ def cmd_info(args):
             print(f"- {k}: {v}")
 
 def cmd_mount(args):
+    import tempfile
     dmg = Path(args.dmg)
     mnt = Path(args.mountpoint) if args.mountpoint else Path(tempfile.mkdtemp(prefix='pokerok_mnt_'))
     mp, dev = hdiutil_attach(dmg, mnt)
@@ -163,44 +389,144 @@ def cmd_mount(args):
 
 def cmd_list(args):
     dmg = Path(args.dmg)
-    with tempfile.TemporaryDirectory(prefix='pokerok_mnt_') as tmp:
-        mp, dev = hdiutil_attach(dmg, Path(tmp))
-        try:
-            print(f"Содержимое {mp}:")
-            for line in list_top(mp):
-                print("  ", line)
-        finally:
-            hdiutil_detach(dev)
+    with mounted(dmg) as (mp, dev):
+        print_listing(mp)
 
 def cmd_copy(args):
     dmg = Path(args.dmg)
     dest = Path(args.dest).expanduser()
-    with tempfile.TemporaryDirectory(prefix='pokerok_mnt_') as tmp:
-        mp, dev = hdiutil_attach(dmg, Path(tmp))
-        try:
-            app = find_app_bundle(mp)
-            if not app:
-                raise RuntimeError("В образе не найден .app пакет.")
-            out = copy_app(app, dest, dry_run=args.dry_run)
-            print(f"{'[DRY-RUN] ' if args.dry_run else ''}Готово: {out}")
-        finally:
-            hdiutil_detach(dev)
+    with mounted(dmg) as (mp, dev):
+        app = require_app_bundle(mp)
+        out = copy_app(app, dest, dry_run=args.dry_run)
+        print(f"{'[DRY-RUN] ' if args.dry_run else ''}Готово: {out}")
 
 def cmd_verify(args):
     dmg = Path(args.dmg)
-    with tempfile.TemporaryDirectory(prefix='pokerok_mnt_') as tmp:
-        mp, dev = hdiutil_attach(dmg, Path(tmp))
+    with mounted(dmg) as (mp, dev):
+        app = require_app_bundle(mp)
+        verify_app(app, fast=args.fast)
+
+def cmd_full(args):
+    # Хеш считается в отдельном потоке, пока hdiutil монтирует образ: время ~ max(T_hash, T_attach)
+    dmg = Path(args.dmg)
+    label, hasher = HASHERS[args.algo]
+    result = {}
+    cancel = threading.Event()
+    # sha256-tree держит пул потоков, который процесс ждет при выходе, — его надо остановить явно
+    hash_kwargs = {'cancel': cancel} if hasher is sha256tree else {}
+
+    def hash_worker():
         try:
-            app = find_app_bundle(mp)
-            if not app:
-                raise RuntimeError("В образе не найден .app пакет.")
-            print(f"Проверяем: {app}")
-            ok_gate, msg_gate = spctl_assess(app)
-            print(f"Gatekeeper: {'OK' if ok_gate else 'FAIL'} — {msg_gate}")
-            ok_sign, msg_sign = codesign_verify(app)
-            print(f"codesign:   {'OK' if ok_sign else 'FAIL'} — {msg_sign}")
-        finally:
-            hdiutil_detach(dev)
+            result['digest'] = hasher(dmg, **hash_kwargs)
+        except Exception as e:
+            result['error'] = e
+
+    # daemon: при ошибке attach поток бросается, а не дожидается конца хеширования многогигабайтного образа
+    worker = threading.Thread(target=hash_worker, daemon=True)
+    worker.start()
+    try:
+        with mounted(dmg) as (mp, dev):
+            app = require_app_bundle(mp)
+            worker.join()
+            if 'error' in result:
+                raise result['error']
+            h, size = result['digest']
+            print(f"Файл: {args.dmg}")
+            print(f"{label}: {h}")
+            print(f"Размер: {size} байт ({size/1024/1024:.2f} МБ)")
+            verify_app(app, fast=args.fast)
+    except BaseException:
+        cancel.set()
+        raise
+
+def serve_request(req: dict, dmg: Path, mp: Path) -> bool:
+    """
+    Выполняет один запрос к уже смонтированному образу. Вывод идет в stdout
+    (перехватывается вызывающим). Возвращает False, если сервер пора остановить.
+    """
+    op = req.get('op')
+    if op == 'list':
+        print_listing(mp)
+    elif op == 'verify':
+        verify_app(require_app_bundle(mp), fast=bool(req.get('fast', False)))
+    elif op == 'copy':
+        dry_run = bool(req.get('dry_run', False))
+        out = copy_app(require_app_bundle(mp), Path(req.get('dest', '/Applications')).expanduser(), dry_run=dry_run)
+        print(f"{'[DRY-RUN] ' if dry_run else ''}Готово: {out}")
+    elif op == 'hash':
+        cmd_hash(argparse.Namespace(dmg=str(dmg), algo=req.get('algo', 'sha256')))
+    elif op == 'quit':
+        return False
+    else:
+        raise RuntimeError(f"Неизвестная операция: {op!r}")
+    return True
+
+def cmd_serve(args):
+    # Монтируем один раз и обслуживаем запросы по Unix-сокету: attach/detach не платятся на каждую команду
+    import io
+    import json
+    import socket
+    dmg = Path(args.dmg)
+    sock_path = Path(args.socket)
+    if os.path.lexists(sock_path):
+        # Удаляем только осиротевший сокет: не обычный файл и не сокет работающего serve
+        if not stat.S_ISSOCK(os.lstat(sock_path).st_mode):
+            raise RuntimeError(f"{sock_path} существует и не является сокетом — укажите другой --socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(sock_path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                sock_path.unlink()
+            else:
+                raise RuntimeError(f"На {sock_path} уже отвечает другой serve")
+    with mounted(dmg) as (mp, dev):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as srv:
+            # copy удаляет и перезаписывает dest по запросу клиента — доступ только владельцу,
+            # umask закрывает окно между bind и chmod
+            old_umask = os.umask(0o177)
+            try:
+                srv.bind(str(sock_path))
+            finally:
+                os.umask(old_umask)
+            try:
+                os.chmod(sock_path, 0o600)
+                srv.listen()
+                print(f"Смонтировано: {mp}\nУстройство: {dev}\nСокет: {sock_path}")
+                print('Запросы — JSON по строке: {"op": "list|verify|copy|hash|quit"}')
+                running = True
+                while running:
+                    conn, _ = srv.accept()
+                    # Клиент может закрыть соединение, не дождавшись ответа (echo | nc -U) —
+                    # это не повод останавливать сервер и отмонтировать образ
+                    try:
+                        # Читаем байты и декодируем каждую строку внутри try запроса: битый UTF-8 —
+                        # ошибка этого запроса. А текстовый rw-поток при записи терял бы
+                        # уже прочитанные следующие строки
+                        with conn, conn.makefile('rb') as reader:
+                            for raw in reader:
+                                if not raw.strip():
+                                    continue
+                                buf = io.StringIO()
+                                try:
+                                    req = json.loads(raw.decode('utf-8'))
+                                    with redirect_stdout(buf):
+                                        running = serve_request(req, dmg, mp)
+                                    reply = {'ok': True, 'output': buf.getvalue()}
+                                except Exception as e:
+                                    reply = {'ok': False, 'output': buf.getvalue(), 'error': str(e)}
+                                try:
+                                    conn.sendall((json.dumps(reply, ensure_ascii=False) + '\n').encode('utf-8'))
+                                except (BrokenPipeError, ConnectionResetError):
+                                    break
+                                if not running:
+                                    break
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    except Exception as e:
+                        # Любая другая ошибка соединения закрывает только его, а не весь сервер
+                        print(f"Ошибка соединения: {type(e).__name__}: {e}", file=sys.stderr)
+            finally:
+                sock_path.unlink(missing_ok=True)
 
 def cmd_detach(args):
     target = None
@@ -214,58 +540,94 @@ def cmd_detach(args):
     hdiutil_detach(target)
     print(f"Отмонтировано: {target}")
 
-def build_parser():
+COMMANDS = ('hash', 'info', 'mount', 'list', 'copy', 'verify', 'full', 'serve', 'detach')
+
+def build_parser(only: Optional[str] = None):
+    """
+    Строит парсер. Если задан only, создается только этот сабпарсер — знать
+    остальные при обычном запуске не нужно (полный парсер нужен для --help и ошибок).
+    """
     p = argparse.ArgumentParser(description="Инструменты для проверки/работы с pokerok.dmg на macOS")
     sub = p.add_subparsers(dest='cmd', required=True)
 
-    ph = sub.add_parser('hash', help='Посчитать SHA-256 и размер файла')
-    ph.add_argument('dmg')
-    ph.set_defaults(func=cmd_hash)
+    if only in (None, 'hash'):
+        ph = sub.add_parser('hash', help='Посчитать хеш (SHA-256/BLAKE3) и размер файла')
+        ph.add_argument('dmg')
+        ph.add_argument('--algo', choices=sorted(HASHERS), default='sha256',
+                        help='Алгоритм хеширования (sha256-tree — параллельный, другой дайджест; '
+                             'blake3 требует pip-пакет blake3)')
+        ph.add_argument('--drop-cache', action='store_true',
+                        help='Не засорять кэш страниц содержимым DMG (F_NOCACHE на macOS), только sha256')
+        ph.set_defaults(func=cmd_hash)
+
+    if only in (None, 'info'):
+        pi = sub.add_parser('info', help='Показать метаданные DMG (hdiutil -plist)')
+        pi.add_argument('dmg')
+        pi.add_argument('--raw', action='store_true', help='Напечатать вывод hdiutil imageinfo как есть, без разбора plist')
+        pi.set_defaults(func=cmd_info)
+
+    if only in (None, 'mount'):
+        pm = sub.add_parser('mount', help='Смонтировать DMG и напечатать mountpoint/device')
+        pm.add_argument('dmg')
+        pm.add_argument('--mountpoint', '-m', help='Желаемая точка монтирования')
+        pm.set_defaults(func=cmd_mount)
 
-    pi = sub.add_parser('info', help='Показать метаданные DMG (hdiutil -plist)')
-    pi.add_argument('dmg')
-    pi.set_defaults(func=cmd_info)
+    if only in (None, 'list'):
+        pl = sub.add_parser('list', help='Смонтировать, показать содержимое верхнего уровня, отмонтировать')
+        pl.add_argument('dmg')
+        pl.set_defaults(func=cmd_list)
 
-    pm = sub.add_parser('mount', help='Смонтировать DMG и напечатать mountpoint/device')
-    pm.add_argument('dmg')
-    pm.add_argument('--mountpoint', '-m', help='Желаемая точка монтирования')
-    pm.set_defaults(func=cmd_mount)
+    if only in (None, 'copy'):
+        pc = sub.add_parser('copy', help='Скопировать .app из DMG (по умолчанию в /Applications)')
+        pc.add_argument('dmg')
+        pc.add_argument('--dest', default='/Applications')
+        pc.add_argument('--dry-run', action='store_true', help='Только показать, что будет скопировано')
+        pc.set_defaults(func=cmd_copy)
 
-    pl = sub.add_parser('list', help='Смонтировать, показать содержимое верхнего уровня, отмонтировать')
-    pl.add_argument('dmg')
-    pl.set_defaults(func=cmd_list)
+    if only in (None, 'verify'):
+        pv = sub.add_parser('verify', help='Проверить Gatekeeper и codesign .app внутри DMG')
+        pv.add_argument('dmg')
+        pv.add_argument('--fast', action='store_true',
+                        help='Быстрая проверка codesign: только основной исполняемый файл, без --deep --strict')
+        pv.set_defaults(func=cmd_verify)
 
-    pc = sub.add_parser('copy', help='Скопировать .app из DMG (по умолчанию в /Applications)')
-    pc.add_argument('dmg')
-    pc.add_argument('--dest', default='/Applications')
-    pc.add_argument('--dry-run', action='store_true', help='Только показать, что будет скопировано')
-    pc.set_defaults(func=cmd_copy)
+    if only in (None, 'full'):
+        pf = sub.add_parser('full', help='Хеш + монтирование + проверка .app за один проход (хеш параллельно с attach)')
+        pf.add_argument('dmg')
+        pf.add_argument('--algo', choices=sorted(HASHERS), default='sha256', help='Алгоритм хеширования')
+        pf.add_argument('--fast', action='store_true', help='Быстрая проверка codesign (без --deep --strict)')
+        pf.set_defaults(func=cmd_full)
 
-    pv = sub.add_parser('verify', help='Проверить Gatekeeper и codesign .app внутри DMG')
-    pv.add_argument('dmg')
-    pv.set_defaults(func=cmd_verify)
+    if only in (None, 'serve'):
+        ps = sub.add_parser('serve', help='Смонтировать один раз и принимать JSON-запросы через Unix-сокет')
+        ps.add_argument('dmg')
+        ps.add_argument('--socket', default='/tmp/pokerok.sock', help='Путь Unix-сокета (по умолчанию /tmp/pokerok.sock)')
+        ps.set_defaults(func=cmd_serve)
 
-    pd = sub.add_parser('detach', help='Отмонтировать по устройству или mountpoint')
-    g = pd.add_mutually_exclusive_group(required=True)
-    g.add_argument('-dev', '--device', help='Напр. /dev/disk4')
-    g.add_argument('-m', '--mountpoint', help='Путь точки монтирования')
-    pd.set_defaults(func=cmd_detach)
+    if only in (None, 'detach'):
+        pd = sub.add_parser('detach', help='Отмонтировать по устройству или mountpoint')
+        g = pd.add_mutually_exclusive_group(required=True)
+        g.add_argument('-dev', '--device', help='Напр. /dev/disk4')
+        g.add_argument('-m', '--mountpoint', help='Путь точки монтирования')
+        pd.set_defaults(func=cmd_detach)
 
     return p
 
 def main():
     if sys.platform != 'darwin':
         print("Внимание: этот скрипт рассчитан на macOS (darwin).", file=sys.stderr)
-    parser = build_parser()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else None
+    parser = build_parser(only=cmd if cmd in COMMANDS else None)
     args = parser.parse_args()
     try:
         args.func(args)
     except subprocess.CalledProcessError as e:
         print(f"Команда завершилась ошибкой [{e.returncode}]: {' '.join(e.cmd)}", file=sys.stderr)
-        if e.stdout:
-            print("STDOUT:\n" + e.stdout, file=sys.stderr)
-        if e.stderr:
-            print("STDERR:\n" + e.stderr, file=sys.stderr)
+        out, err = (x.decode(errors='replace') if isinstance(x, bytes) else x for x in (e.stdout, e.stderr))
+        if out:
+            print("STDOUT:\n" + out, file=sys.stderr)
+        if err:
+            print("STDERR:\n" + err, file=sys.stderr)
         sys.exit(e.returncode)
     except Exception as e:
         print(f"Ошибка: {e}", file=sys.stderr)